@@ -1,203 +1,743 @@
-# app.py
-import os
-import json
-from flask import Flask, request, jsonify, render_template
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-
-load_dotenv()  # Load the .env file
-
-# --- Configuration ---
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") 
-try:
-    client = genai.Client(api_key=GEMINI_API_KEY)
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    client = None
-
-GAME_STATE = {} 
-
-app = Flask(__name__)
-
-# --- NEW: Narrative Tone Mapping ---
-TONE_MAP = {
-    "Sci-fi": "Clinical, technical, focused on cosmic scale, system failures, or computer logs.",
-    "Medieval": "Mythic, slightly formal, referring to royalty, oaths, divine law, and ancient structures.",
-    "Mythological": "Epic, archaic language, focused on fate, gods, heroes, and destiny.",
-    "Horror": "Suspenseful, sensory, using first-person dread, panic, and environmental details (smell, cold).",
-    "Modern": "Casual, journalistic, focused on news reports, conspiracy theories, or digital communications (text messages).",
-}
-
-# --- Gemini API Prompt & Schema ---
-
-SYSTEM_INSTRUCTION = (
-    "You are a master ARG (Alternate Reality Game) creator. Your task is to generate a complete, multi-stage, "
-    "short-story ARG based on a user's chosen difficulty, genre, and a specific number of puzzles. "
-    "The difficulty level must affect the complexity of the puzzles. "
-    "\n\n**CRITICAL RULE:** You must double-check all ciphers, riddles, and logical puzzles. The 'puzzle_text' "
-    "must logically and provably decrypt or solve to the exact 'solution'. "
-    "\n\n**Strictly** adhere to the JSON schema provided for the output."
-)
-
-# ... (PUZZLE_SCHEMA and STORY_SCHEMA remain the same) ...
-
-PUZZLE_SCHEMA = types.Schema(
-    type=types.Type.OBJECT,
-    properties={
-        "puzzle_number": types.Schema(type=types.Type.INTEGER, description="The current puzzle in the sequence (e.g., 1, 2, 3...)."),
-        "title": types.Schema(type=types.Type.STRING, description="A short, intriguing title for the puzzle."),
-        "puzzle_text": types.Schema(type=types.Type.STRING, description="The actual riddle, cypher, logic grid instructions, or coordinate puzzle."),
-        "solution": types.Schema(type=types.Type.STRING, description="The single correct answer the user must input. Case-insensitive, stripped of extra spaces/punctuation for checking."),
-        "narrative_continuation": types.Schema(type=types.Type.STRING, description="The story text the user sees upon successfully solving the puzzle. This leads into the next puzzle (or the game's ending)."),
-        "hint_1": types.Schema(type=types.Type.STRING, description="The first, most vague hint for the puzzle."),
-        "hint_2": types.Schema(type=types.Type.STRING, description="The second, more helpful hint for the puzzle."),
-        "hint_3": types.Schema(type=types.Type.STRING, description="The third, most direct hint for the puzzle."),
-    },
-    required=["puzzle_number", "title", "puzzle_text", "solution", "narrative_continuation", "hint_1", "hint_2", "hint_3"]
-)
-
-STORY_SCHEMA = types.Schema(
-    type=types.Type.OBJECT,
-    properties={
-        "story_title": types.Schema(type=types.Type.STRING, description="A title for the entire multi-stage ARG story."),
-        "introduction": types.Schema(type=types.Type.STRING, description="The opening narrative text that sets up the game and the first puzzle."),
-        "puzzles": types.Schema(type=types.Type.ARRAY, items=PUZZLE_SCHEMA, description="A list of puzzle objects, matching the number requested in the prompt."),
-        "ending_text": types.Schema(type=types.Type.STRING, description="The final narrative text shown after the last puzzle is solved.")
-    },
-    required=["story_title", "introduction", "puzzles", "ending_text"]
-)
-
-# --- Routes ---
-
-@app.route('/')
-def serve_index():
-    """Serves the main HTML/JS/CSS file."""
-    return render_template('index.html')
-
-@app.route('/generate_story', methods=['POST'])
-def generate_story():
-    """
-    Handles the user's initial choices and calls Gemini to generate the full story/puzzles.
-    """
-    if not client:
-        return jsonify({"error": "Gemini API client not initialized. Check your API key."}), 500
-
-    data = request.get_json()
-    difficulty = data.get('difficulty')
-    genre = data.get('genre')
-
-    if not difficulty or not genre:
-        return jsonify({"error": "Missing difficulty or genre."}), 400
-
-    difficulty_map = {
-        "Easy": 7,
-        "Medium": 5,
-        "Hard": 3
-    }
-    num_puzzles = difficulty_map.get(difficulty, 5) 
-    narrative_tone = TONE_MAP.get(genre, "Neutral and clear.") # Get the specific tone
-
-    print(f"Generating story: Difficulty={difficulty}, Genre={genre}, Puzzles={num_puzzles}")
-
-    # PROMPT NOW INCLUDES TONE INSTRUCTION
-    user_prompt = (
-        f"Generate a complete **{num_puzzles}-puzzle** ARG story. "
-        f"Difficulty: **{difficulty}**. Genre: **{genre}**. "
-        f"Narrative Tone: **{narrative_tone}**. " 
-        "Ensure the puzzles blend into the narrative and the difficulty level is accurately represented."
-    )
-
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=user_prompt,
-            config=types.GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
-                response_mime_type="application/json",
-                response_schema=STORY_SCHEMA,
-            ),
-        )
-
-        story_data = json.loads(response.text)
-        
-        if len(story_data['puzzles']) != num_puzzles:
-            print(f"Warning: Gemini generated {len(story_data['puzzles'])} puzzles, but {num_puzzles} were requested.")
-
-        GAME_STATE['story'] = story_data
-        GAME_STATE['current_puzzle_index'] = 0
-        
-        first_puzzle_index = GAME_STATE['current_puzzle_index']
-        current_puzzle = story_data['puzzles'][first_puzzle_index]
-        
-        return jsonify({
-            "success": True,
-            "title": story_data['story_title'],
-            "introduction": story_data['introduction'],
-            "puzzle": current_puzzle,
-            "puzzle_index": 1,
-            "total_puzzles": len(story_data['puzzles'])
-        })
-
-    except Exception as e:
-        print(f"Gemini API Error: {e}")
-        return jsonify({"error": f"Failed to generate story with Gemini: {e}"}), 500
-
-
-@app.route('/check_answer', methods=['POST'])
-def check_answer():
-    """
-    Checks the user's submitted answer against the stored solution.
-    """
-    data = request.get_json()
-    user_answer = data.get('answer', '').strip().lower()
-    
-    if 'story' not in GAME_STATE:
-        return jsonify({"error": "Game not initialized. Please start a new game."}), 400
-
-    current_index = GAME_STATE['current_puzzle_index']
-    story_data = GAME_STATE['story']
-    
-    if current_index >= len(story_data['puzzles']):
-        return jsonify({"success": False, "message": "Game already finished."})
-
-    current_puzzle = story_data['puzzles'][current_index]
-    
-    correct_solution = current_puzzle['solution'].strip().lower()
-    
-    if user_answer == correct_solution:
-        GAME_STATE['current_puzzle_index'] += 1
-        next_index = GAME_STATE['current_puzzle_index']
-        
-        if next_index < len(story_data['puzzles']):
-            next_puzzle = story_data['puzzles'][next_index]
-            response_data = {
-                "success": True,
-                "status": "correct",
-                "narrative": current_puzzle['narrative_continuation'],
-                "puzzle": next_puzzle,
-                "puzzle_index": next_index + 1
-            }
-        else:
-            # Game is complete
-            response_data = {
-                "success": True,
-                "status": "complete",
-                "narrative": current_puzzle['narrative_continuation'], 
-                "ending_text": story_data['ending_text']
-            }
-        
-        return jsonify(response_data)
-        
-    else:
-        return jsonify({
-            "success": True,
-            "status": "incorrect",
-            "message": "The code is incorrect. Try again."
-        })
-
-if __name__ == '__main__':
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
-    print("Starting Flask server. Access at http://127.0.0.1:5000/")
+# app.py
+import asyncio
+import hashlib
+import os
+import string
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+import cachetools
+import diskcache
+import fastjsonschema
+import ijson
+import msgpack
+import orjson
+import pygtrie
+import redis
+from rapidfuzz.distance import DamerauLevenshtein
+from flask import Flask, request, send_from_directory, stream_with_context
+from google import genai
+from google.genai import types
+from dotenv import load_dotenv
+from itsdangerous import URLSafeSerializer, BadSignature
+
+load_dotenv()  # Load the .env file
+
+# --- Configuration ---
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+# flash-lite is plenty for schema-constrained puzzle generation and roughly
+# halves per-token cost and latency; override via env if quality regresses.
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash-lite")
+try:
+    client = genai.Client(api_key=GEMINI_API_KEY)
+except Exception as e:
+    print(f"Error initializing Gemini client: {e}")
+    client = None
+
+# Per-session game state, keyed by a signed session id carried in a cookie.
+# Each entry holds flat arrays so /check_answer only indexes into lists:
+#   'sol': pre-normalized (stripped/lowercased) solutions
+#   'narr': narrative_continuation per puzzle
+#   'puzzles': the raw puzzle dicts (for sending the next puzzle to the client)
+#   'ending_text': final narrative
+#   'idx': current puzzle index
+#
+# With multiple gunicorn workers an in-process dict breaks (the next request
+# may land on a different process), so when REDIS_URL is set sessions live in
+# Redis, serialized with msgpack. Without it, the in-process dict still works
+# for single-process dev runs.
+SESSIONS = {}
+
+SESSION_COOKIE = "arg_session"
+SESSION_TTL = 3600  # seconds a Redis-backed session survives without activity
+
+# Serializes /check_answer per session (threading.Lock is gevent-safe after
+# monkey-patching), and remembers recent responses for 30s keyed by the
+# client's X-Request-Id so true retries replay instead of re-running.
+# The lock map is TTL-bounded so long-running workers don't accumulate one
+# permanent lock per session ever seen; entries age out with the sessions.
+_answer_locks = cachetools.TTLCache(maxsize=4096, ttl=SESSION_TTL)
+_answer_locks_guard = threading.Lock()
+_recent_answers = cachetools.TTLCache(maxsize=1024, ttl=30)
+
+
+def _answer_lock(sid):
+    """Returns (creating if needed) the serialization lock for one session."""
+    with _answer_locks_guard:
+        lock = _answer_locks.get(sid)
+        if lock is None:
+            lock = threading.Lock()
+            _answer_locks[sid] = lock
+        return lock
+
+_redis = None
+if os.environ.get("REDIS_URL"):
+    try:
+        _redis = redis.Redis.from_url(os.environ["REDIS_URL"])
+        _redis.ping()
+    except Exception as e:
+        print(f"Error connecting to Redis: {e}. Falling back to in-process sessions.")
+        _redis = None
+
+# Answers are checked case-insensitively with spaces trimmed and punctuation
+# dropped, as promised in the game rules. One table handles both the
+# lowercasing and the punctuation strip, so normalization is a single
+# C-level translate pass instead of translate + lower.
+_NORM_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase, string.punctuation)
+
+
+def _normalize_answer(text):
+    """Normalizes an answer for comparison: lowercase, no punctuation, trimmed."""
+    return text.translate(_NORM_TABLE).strip()
+
+
+def _solution_hash(solution):
+    """Stable 8-byte digest of a normalized solution for the reverse index.
+
+    BLAKE2b rather than the built-in hash() so the keys survive process
+    restarts if a session store is ever persisted.
+    """
+    return hashlib.blake2b(solution.encode(), digest_size=8).digest()
+
+
+def _new_session_state():
+    """Returns an empty session; puzzles are appended as they arrive from the stream."""
+    return {
+        'sol': [],
+        'sol_idx': {},
+        'trie': pygtrie.CharTrie(),
+        'narr': [],
+        'puzzles': [],
+        'ending_text': None,
+        'idx': 0,
+        'done': False,
+    }
+
+
+def _append_puzzle(state, puzzle):
+    """Adds one puzzle to a session's flat arrays, reverse index, and trie."""
+    index = len(state['puzzles'])
+    solution = _normalize_answer(puzzle['solution'])
+    state['puzzles'].append(puzzle)
+    state['sol'].append(solution)
+    state['sol_idx'][_solution_hash(solution)] = index
+    state['narr'].append(puzzle['narrative_continuation'])
+    state['trie'][solution] = index
+    return index
+
+
+def _save_session(sid, state):
+    """Persists a session: setex into Redis (trie excluded), or the local dict."""
+    if _redis is None:
+        SESSIONS[sid] = state
+        return
+    # The story stream and /check_answer may save concurrently from different
+    # workers; idx only ever moves forward, so keep the larger value rather
+    # than letting a stale writer roll the player's progress back.
+    packed_old = _redis.get(sid)
+    if packed_old is not None:
+        old_idx = msgpack.unpackb(packed_old, raw=False).get('idx', 0)
+        if old_idx > state['idx']:
+            state['idx'] = old_idx
+    packed = msgpack.packb({k: v for k, v in state.items() if k != 'trie'}, use_bin_type=True)
+    _redis.setex(sid, SESSION_TTL, packed)
+
+
+def _load_session(sid):
+    """Loads a session by id, rebuilding the (unserializable) trie on the Redis path."""
+    if _redis is None:
+        return SESSIONS.get(sid)
+    packed = _redis.get(sid)
+    if packed is None:
+        return None
+    state = msgpack.unpackb(packed, raw=False)
+    trie = pygtrie.CharTrie()
+    for index, solution in enumerate(state['sol']):
+        trie[solution] = index
+    state['trie'] = trie
+    return state
+
+
+def _wait_for_puzzle(sid, state, index, timeout=15.0):
+    """Polls briefly until the story stream has delivered puzzle `index` (or finished).
+
+    The stream may be running in another worker process, so each poll re-reads
+    the session. Returns the freshest state seen.
+    """
+    deadline = time.monotonic() + timeout
+    while not state['done'] and len(state['puzzles']) <= index and time.monotonic() < deadline:
+        time.sleep(0.1)
+        state = _load_session(sid) or state
+    return state
+
+app = Flask(__name__)
+app.secret_key = os.environ.get("SECRET_KEY")
+if not app.secret_key:
+    if os.environ.get("REDIS_URL"):
+        # Without a shared key, each gunicorn worker signs cookies with its
+        # own random value and rejects every other worker's sessions -- the
+        # exact failure the Redis session store exists to prevent.
+        raise RuntimeError("SECRET_KEY must be set when REDIS_URL is configured.")
+    app.secret_key = uuid.uuid4().hex  # single-process dev fallback
+
+_session_signer = URLSafeSerializer(app.secret_key, salt="arg-session")
+
+
+def _get_session():
+    """Returns (sid, state) for the current request's session cookie, or (None, None)."""
+    cookie = request.cookies.get(SESSION_COOKIE)
+    if not cookie:
+        return None, None
+    try:
+        sid = _session_signer.loads(cookie)
+    except BadSignature:
+        return None, None
+    return sid, _load_session(sid)
+
+
+def ojsonify(payload):
+    """Drop-in jsonify replacement that serializes with orjson (C extension).
+
+    The story payloads are multi-KB nested dicts; orjson.dumps is several times
+    faster than the stdlib encoder Flask's jsonify uses.
+    """
+    return app.response_class(orjson.dumps(payload), mimetype='application/json')
+
+# --- NEW: Narrative Tone Mapping ---
+# MappingProxyType keeps these read-only; they are shared constants, built once
+# at import instead of per request.
+TONE_MAP = MappingProxyType({
+    "Sci-fi": "Clinical, technical, focused on cosmic scale, system failures, or computer logs.",
+    "Medieval": "Mythic, slightly formal, referring to royalty, oaths, divine law, and ancient structures.",
+    "Mythological": "Epic, archaic language, focused on fate, gods, heroes, and destiny.",
+    "Horror": "Suspenseful, sensory, using first-person dread, panic, and environmental details (smell, cold).",
+    "Modern": "Casual, journalistic, focused on news reports, conspiracy theories, or digital communications (text messages).",
+})
+
+DIFFICULTY_MAP = MappingProxyType({
+    "Easy": 7,
+    "Medium": 5,
+    "Hard": 3,
+})
+
+# PROMPT NOW INCLUDES TONE INSTRUCTION
+USER_PROMPT_TMPL = (
+    "Generate a complete **{n}-puzzle** ARG story. "
+    "Difficulty: **{d}**. Genre: **{g}**. "
+    "Narrative Tone: **{tone}**. "
+    "Ensure the puzzles blend into the narrative and the difficulty level is accurately represented."
+)
+
+# Difficulty and genre come from a tiny fixed vocabulary, so map each inbound
+# string to its interned canonical form once per request; every dict lookup
+# after that hits the pointer-equality fast path instead of re-hashing.
+DIFFICULTY_IDS = {d: sys.intern(d) for d in DIFFICULTY_MAP}
+GENRE_IDS = {g: sys.intern(g) for g in TONE_MAP}
+
+# Inbound request validation. fastjsonschema code-generates the validator at
+# import, so the handler does one function call instead of branchy get/None
+# checks, and bogus payloads are rejected with a precise message.
+_validate_generate_request = fastjsonschema.compile({
+    "type": "object",
+    "required": ["difficulty", "genre"],
+    "properties": {
+        "difficulty": {"enum": list(DIFFICULTY_MAP)},
+        "genre": {"enum": list(TONE_MAP)},
+    },
+})
+
+# --- Gemini API Prompt & Schema ---
+
+SYSTEM_INSTRUCTION = (
+    "You are a master ARG (Alternate Reality Game) creator. Your task is to generate a complete, multi-stage, "
+    "short-story ARG based on a user's chosen difficulty, genre, and a specific number of puzzles. "
+    "The difficulty level must affect the complexity of the puzzles. "
+    "\n\n**CRITICAL RULE:** You must double-check all ciphers, riddles, and logical puzzles. The 'puzzle_text' "
+    "must logically and provably decrypt or solve to the exact 'solution'. "
+    "\n\n**Strictly** adhere to the JSON schema provided for the output."
+)
+
+# Field constraints are as tight as the domain allows: the narrower the
+# schema, the smaller the token search space Gemini's constrained decoder has
+# to consider, and the fewer invalid-JSON retries we pay for. The solution
+# pattern also guarantees downstream normalization never sees exotic Unicode.
+
+PUZZLE_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "puzzle_number": types.Schema(type=types.Type.INTEGER, description="The current puzzle in the sequence (e.g., 1, 2, 3...)."),
+        "title": types.Schema(type=types.Type.STRING, max_length=100, description="A short, intriguing title for the puzzle."),
+        "puzzle_text": types.Schema(type=types.Type.STRING, description="The actual riddle, cypher, logic grid instructions, or coordinate puzzle."),
+        "solution": types.Schema(type=types.Type.STRING, max_length=80, pattern="^[A-Za-z0-9 ,.'-]{1,80}$", description="The single correct answer the user must input. Plain letters, digits, and basic punctuation only. Case-insensitive, stripped of extra spaces/punctuation for checking."),
+        "narrative_continuation": types.Schema(type=types.Type.STRING, description="The story text the user sees upon successfully solving the puzzle. This leads into the next puzzle (or the game's ending)."),
+        "hint_1": types.Schema(type=types.Type.STRING, description="The first, most vague hint for the puzzle."),
+        "hint_2": types.Schema(type=types.Type.STRING, description="The second, more helpful hint for the puzzle."),
+        "hint_3": types.Schema(type=types.Type.STRING, description="The third, most direct hint for the puzzle."),
+    },
+    required=["puzzle_number", "title", "puzzle_text", "solution", "narrative_continuation", "hint_1", "hint_2", "hint_3"]
+)
+
+STORY_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "story_title": types.Schema(type=types.Type.STRING, max_length=100, description="A title for the entire multi-stage ARG story."),
+        "introduction": types.Schema(type=types.Type.STRING, description="The opening narrative text that sets up the game and the first puzzle."),
+        "puzzles": types.Schema(type=types.Type.ARRAY, items=PUZZLE_SCHEMA, min_items=1, max_items=7, description="A list of puzzle objects, matching the number requested in the prompt."),
+        "ending_text": types.Schema(type=types.Type.STRING, description="The final narrative text shown after the last puzzle is solved.")
+    },
+    required=["story_title", "introduction", "puzzles", "ending_text"]
+)
+
+# Wrapper schema for batched pre-warm calls: one request, several independent
+# stories. Sharing the (long) system instruction across the batch amortizes
+# its token cost instead of re-paying it per story.
+BATCH_STORY_SCHEMA = types.Schema(
+    type=types.Type.OBJECT,
+    properties={
+        "variants": types.Schema(type=types.Type.ARRAY, items=STORY_SCHEMA, description="A list of fully independent ARG stories, one per requested variant."),
+    },
+    required=["variants"]
+)
+
+# Prompt for patching a story that came back with too few puzzles: re-asking
+# for just the missing puzzles is far cheaper than regenerating everything.
+TOPUP_PROMPT_TMPL = (
+    "An ARG story for this request came back incomplete: {req} "
+    "The story so far ends with: {context} "
+    "Generate **only puzzle {n} of {total}**, continuing that story and matching its difficulty and tone."
+)
+
+# The config never varies per request, so build it once at import instead of
+# re-validating the schema tree inside every handler call.
+STORY_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,
+    response_mime_type="application/json",
+    response_schema=STORY_SCHEMA,
+)
+
+BATCH_STORY_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,
+    response_mime_type="application/json",
+    response_schema=BATCH_STORY_SCHEMA,
+)
+
+PUZZLE_ONLY_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_INSTRUCTION,
+    response_mime_type="application/json",
+    response_schema=PUZZLE_SCHEMA,
+)
+
+_topup_pool = ThreadPoolExecutor(max_workers=4)
+
+
+def _gen_one_puzzle(n, total, user_prompt, context):
+    """Generates a single replacement puzzle continuing the story so far."""
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=TOPUP_PROMPT_TMPL.format(req=user_prompt, context=context, n=n, total=total),
+        config=PUZZLE_ONLY_CONFIG,
+    )
+    return response.parsed or orjson.loads(response.text)
+
+
+def _topup_puzzles(state, num_puzzles, user_prompt):
+    """Yields the missing puzzles, generated by parallel targeted re-asks.
+
+    All re-asks are submitted up front so their API round-trips overlap; the
+    results are consumed in story order.
+    """
+    have = len(state['puzzles'])
+    context = state['narr'][-1] if state['narr'] else "(story introduction)"
+    futures = {
+        n: _topup_pool.submit(_gen_one_puzzle, n, num_puzzles, user_prompt, context)
+        for n in range(have + 1, num_puzzles + 1)
+    }
+    for n in sorted(futures):
+        try:
+            yield futures[n].result()
+        except Exception as e:
+            print(f"Puzzle top-up {n} failed: {e}")
+            return
+
+# --- Story cache ---
+# Completed generations, keyed by a hash of the full prompt. Demos replay the
+# same handful of (difficulty, genre) combos, and each hit skips a multi-second
+# Gemini call entirely.
+
+_story_cache = diskcache.Cache('.gemini_cache', size_limit=2**30)
+
+
+def _cache_key(user_prompt):
+    """Content-addressed cache key over everything that shapes the generation.
+
+    The model id is part of the key: GEMINI_MODEL is switchable via env, and
+    stories cached from one model must not be served as another's output.
+    """
+    # BLAKE2b: faster than SHA-256 here and the keys are non-adversarial.
+    material = "\n".join((GEMINI_MODEL, SYSTEM_INSTRUCTION, user_prompt))
+    return hashlib.blake2b(material.encode()).hexdigest()
+
+# --- Pre-warm pool ---
+# Pre-generated stories per (difficulty, genre) combo, kept topped up by an
+# asyncio refill loop on a background thread so /generate_story can usually
+# skip the multi-second Gemini wait. Gemini calls go through the async client
+# (client.aio) so several buckets refill concurrently on one thread.
+
+PREWARM_BATCH_SIZE = 3
+POOL_TARGET = 8            # stories to keep per bucket
+POOL_LOW_WATERMARK = 2     # refill a bucket once it drops below this
+POOL_MAX_CONCURRENCY = 10  # cap on in-flight Gemini calls across all buckets
+
+_prewarmed = {}            # (difficulty, genre) -> deque of story dicts
+_prewarm_wanted = set()    # combos players have asked for; the loop keeps these warm
+_prewarm_inflight = set()
+_prewarm_lock = threading.Lock()
+
+
+def _pop_prewarmed(difficulty, genre):
+    """Pops a pre-generated story for this combo, or None if the pool is empty."""
+    with _prewarm_lock:
+        bucket = _prewarmed.get((difficulty, genre))
+        if bucket:
+            return bucket.popleft()
+    return None
+
+
+def _schedule_prewarm(difficulty, genre):
+    """Marks a combo as in use so the refill loop keeps its bucket warm."""
+    with _prewarm_lock:
+        _prewarm_wanted.add((difficulty, genre))
+
+
+def _batch_prompt(difficulty, genre):
+    """Builds the batched pre-warm prompt for one (difficulty, genre) combo."""
+    num_puzzles = DIFFICULTY_MAP.get(difficulty, 5)
+    narrative_tone = TONE_MAP.get(genre, "Neutral and clear.")
+    return (
+        f"Generate **{PREWARM_BATCH_SIZE} fully independent** ARG stories, each a complete "
+        f"**{num_puzzles}-puzzle** story. "
+        f"Difficulty: **{difficulty}**. Genre: **{genre}**. "
+        f"Narrative Tone: **{narrative_tone}**. "
+        "The stories must not share characters, settings, or solutions. "
+        "Return them in the 'variants' array. "
+        "Ensure the puzzles blend into the narrative and the difficulty level is accurately represented."
+    )
+
+
+async def _refill_bucket(difficulty, genre, semaphore):
+    """Tops one bucket up to POOL_TARGET with batched async Gemini calls."""
+    try:
+        while True:
+            with _prewarm_lock:
+                bucket = _prewarmed.setdefault((difficulty, genre), deque())
+                if len(bucket) >= POOL_TARGET:
+                    return
+            async with semaphore:
+                response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=_batch_prompt(difficulty, genre),
+                    config=BATCH_STORY_CONFIG,
+                )
+            # The SDK already parsed the JSON to honor response_schema;
+            # re-decoding response.text here would be a second full parse.
+            batch = response.parsed or orjson.loads(response.text)
+            variants = batch['variants']
+            with _prewarm_lock:
+                _prewarmed[(difficulty, genre)].extend(variants)
+            print(f"Pre-warmed {len(variants)} stories for {difficulty}/{genre}")
+    except Exception as e:
+        print(f"Pre-warm failed for {difficulty}/{genre}: {e}")
+    finally:
+        with _prewarm_lock:
+            _prewarm_inflight.discard((difficulty, genre))
+
+
+async def _refill_loop():
+    """Watches all in-use buckets and refills any that run low."""
+    semaphore = asyncio.Semaphore(POOL_MAX_CONCURRENCY)
+    while True:
+        with _prewarm_lock:
+            low = [
+                combo for combo in _prewarm_wanted
+                if combo not in _prewarm_inflight
+                and len(_prewarmed.get(combo, ())) < POOL_LOW_WATERMARK
+            ]
+            _prewarm_inflight.update(low)
+        if low:
+            await asyncio.gather(*(_refill_bucket(d, g, semaphore) for d, g in low))
+        await asyncio.sleep(1)
+
+
+if client:
+    threading.Thread(target=lambda: asyncio.run(_refill_loop()), daemon=True).start()
+
+# --- Routes ---
+
+@app.route('/')
+def serve_index():
+    """Serves the main HTML/JS/CSS file.
+
+    The page has no template variables, so it goes out via send_from_directory
+    with an ETag: repeat loads get a bodyless 304 instead of a re-render.
+    index.html lives next to app.py, not in a templates/ directory.
+    """
+    return send_from_directory(app.root_path, 'index.html',
+                               max_age=3600, conditional=True)
+
+@app.route('/generate_story', methods=['POST'])
+def generate_story():
+    """
+    Handles the user's initial choices and calls Gemini to generate the full story/puzzles.
+    """
+    if not client:
+        return ojsonify({"error": "Gemini API client not initialized. Check your API key."}), 500
+
+    data = request.get_json()
+    try:
+        _validate_generate_request(data)
+    except fastjsonschema.JsonSchemaException as e:
+        return ojsonify({"error": f"Invalid request: {e.message}"}), 400
+
+    difficulty = DIFFICULTY_IDS[data['difficulty']]
+    genre = GENRE_IDS[data['genre']]
+
+    num_puzzles = DIFFICULTY_MAP.get(difficulty, 5)
+    narrative_tone = TONE_MAP.get(genre, "Neutral and clear.") # Get the specific tone
+
+    story_data = _pop_prewarmed(difficulty, genre)
+    _schedule_prewarm(difficulty, genre)  # Top the pool back up for the next request.
+
+    sid = uuid.uuid4().hex
+    state = _new_session_state()
+    _save_session(sid, state)
+    user_prompt = USER_PROMPT_TMPL.format(n=num_puzzles, d=difficulty, g=genre, tone=narrative_tone)
+
+    if story_data is not None:
+        print(f"Serving pre-warmed story: Difficulty={difficulty}, Genre={genre}")
+        body = _emit_story(sid, state, story_data, num_puzzles, user_prompt)
+    else:
+        cache_key = _cache_key(user_prompt)
+        cached = _story_cache.get(cache_key)
+        if cached is not None:
+            print(f"Serving cached story: Difficulty={difficulty}, Genre={genre}")
+            body = _emit_story(sid, state, cached, num_puzzles, user_prompt)
+        else:
+            print(f"Generating story: Difficulty={difficulty}, Genre={genre}, Puzzles={num_puzzles}")
+            body = _stream_story(sid, state, user_prompt, num_puzzles, cache_key)
+
+    response = app.response_class(stream_with_context(body), mimetype='application/x-ndjson')
+    response.set_cookie(SESSION_COOKIE, _session_signer.dumps(sid), httponly=True)
+    return response
+
+
+def _emit_story(sid, state, story_data, num_puzzles, user_prompt):
+    """Replays an already-complete (pre-warmed) story as the NDJSON stream."""
+    yield orjson.dumps({
+        "success": True,
+        "title": story_data['story_title'],
+        "introduction": story_data['introduction'],
+        "total_puzzles": max(len(story_data['puzzles']), num_puzzles)
+    }) + b'\n'
+
+    for puzzle in story_data['puzzles']:
+        index = _append_puzzle(state, puzzle)
+        yield orjson.dumps({"puzzle": puzzle, "puzzle_index": index + 1}) + b'\n'
+
+    if len(state['puzzles']) < num_puzzles:
+        print(f"Warning: story has {len(state['puzzles'])} puzzles, but {num_puzzles} were requested. Topping up.")
+        _save_session(sid, state)
+        for puzzle in _topup_puzzles(state, num_puzzles, user_prompt):
+            index = _append_puzzle(state, puzzle)
+            yield orjson.dumps({"puzzle": puzzle, "puzzle_index": index + 1}) + b'\n'
+
+    state['ending_text'] = story_data['ending_text']
+    state['done'] = True
+    _save_session(sid, state)
+
+
+def _stream_story(sid, state, user_prompt, num_puzzles, cache_key):
+    """Streams a fresh story from Gemini as NDJSON, flushing each piece as it parses.
+
+    The raw JSON chunks are fed through ijson's push parser, so the title and
+    introduction go out after the first few hundred tokens and each puzzle is
+    emitted (and made answerable in the session) while later ones are still
+    being generated.
+    """
+    events = []
+
+    @ijson.coroutine
+    def collect():
+        while True:
+            events.append((yield))
+
+    parser = ijson.parse_coro(collect())
+    builder = None
+    title = None
+    introduction = None
+    meta_sent = False
+
+    try:
+        stream = client.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=user_prompt,
+            config=STORY_CONFIG,
+        )
+
+        for chunk in stream:
+            if not chunk.text:
+                continue
+            parser.send(chunk.text.encode('utf-8'))
+
+            for prefix, event, value in events:
+                if prefix == 'story_title':
+                    title = value
+                elif prefix == 'introduction' and not meta_sent:
+                    meta_sent = True
+                    introduction = value
+                    yield orjson.dumps({
+                        "success": True,
+                        "title": title,
+                        "introduction": value,
+                        "total_puzzles": num_puzzles
+                    }) + b'\n'
+                elif prefix == 'puzzles.item' and event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif builder is not None and prefix.startswith('puzzles.item'):
+                    builder.event(event, value)
+                    if prefix == 'puzzles.item' and event == 'end_map':
+                        puzzle = builder.value
+                        builder = None
+                        index = _append_puzzle(state, puzzle)
+                        _save_session(sid, state)  # answerable before the stream finishes
+                        yield orjson.dumps({"puzzle": puzzle, "puzzle_index": index + 1}) + b'\n'
+                elif prefix == 'ending_text':
+                    state['ending_text'] = value
+            events.clear()
+
+        if len(state['puzzles']) < num_puzzles:
+            print(f"Warning: Gemini generated {len(state['puzzles'])} puzzles, but {num_puzzles} were requested. Topping up.")
+            for puzzle in _topup_puzzles(state, num_puzzles, user_prompt):
+                index = _append_puzzle(state, puzzle)
+                yield orjson.dumps({"puzzle": puzzle, "puzzle_index": index + 1}) + b'\n'
+
+        if meta_sent and state['puzzles'] and state['ending_text'] is not None:
+            _story_cache.set(cache_key, {
+                'story_title': title,
+                'introduction': introduction,
+                'puzzles': state['puzzles'],
+                'ending_text': state['ending_text'],
+            })
+
+    except Exception as e:
+        print(f"Gemini API Error: {e}")
+        yield orjson.dumps({"error": f"Failed to generate story with Gemini: {e}"}) + b'\n'
+    finally:
+        state['done'] = True
+        _save_session(sid, state)
+
+
+@app.route('/check_answer', methods=['POST'])
+def check_answer():
+    """
+    Checks the user's submitted answer against the stored solution.
+
+    The check-and-advance is serialized per session so an impatient
+    double-click can't race on idx and skip a puzzle, and retried requests
+    (same X-Request-Id) replay the previous response instead of re-running.
+    """
+    data = request.get_json()
+    user_answer = _normalize_answer(data.get('answer', ''))
+
+    sid, state = _get_session()
+    if state is None:
+        return ojsonify({"error": "Game not initialized. Please start a new game."}), 400
+
+    with _answer_lock(sid):
+        request_id = request.headers.get('X-Request-Id')
+        if request_id:
+            cached = _recent_answers.get((sid, request_id))
+            if cached is not None:
+                return app.response_class(cached, mimetype='application/json')
+
+        response = _check_answer_locked(sid, state, user_answer)
+        if request_id:
+            _recent_answers[(sid, request_id)] = response.get_data()
+        return response
+
+
+def _check_answer_locked(sid, state, user_answer):
+    """Answer check + state advance; caller holds the session's lock."""
+    current_index = state['idx']
+    state = _wait_for_puzzle(sid, state, current_index)
+
+    if current_index >= len(state['sol']):
+        return ojsonify({"success": False, "message": "Game already finished."})
+
+    # Correctness is decided against the current puzzle's own solution:
+    # stories can repeat a solution, and the reverse index is last-write-wins,
+    # so a hash hit on another index must never veto a correct answer. The
+    # reverse index only powers the cross-stage nudge below.
+    if user_answer == state['sol'][current_index]:
+        state['idx'] += 1
+        _save_session(sid, state)
+        next_index = state['idx']
+        state = _wait_for_puzzle(sid, state, next_index)
+
+        if next_index < len(state['puzzles']):
+            response_data = {
+                "success": True,
+                "status": "correct",
+                "narrative": state['narr'][current_index],
+                "puzzle": state['puzzles'][next_index],
+                "puzzle_index": next_index + 1
+            }
+        else:
+            # Game is complete
+            response_data = {
+                "success": True,
+                "status": "complete",
+                "narrative": state['narr'][current_index],
+                "ending_text": state['ending_text']
+            }
+
+        return ojsonify(response_data)
+        
+    else:
+        matched_index = state['sol_idx'].get(_solution_hash(user_answer))
+        if matched_index is not None and matched_index != current_index:
+            return ojsonify({
+                "success": True,
+                "status": "incorrect",
+                "message": "That code unlocks a different stage. Focus on the current puzzle."
+            })
+
+        # Near-miss check: a prefix hit in the shared solution trie, or a
+        # single-typo Damerau-Levenshtein distance (C implementation), earns a
+        # nudge instead of a flat rejection.
+        expected = state['sol'][current_index]
+        prefix = state['trie'].longest_prefix(user_answer)
+        close = (
+            (prefix and prefix.value == current_index)
+            or DamerauLevenshtein.distance(user_answer, expected, score_cutoff=1) <= 1
+        )
+        if close:
+            return ojsonify({
+                "success": True,
+                "status": "incorrect",
+                "message": "The code is incorrect, but very close. Check your spelling."
+            })
+
+        return ojsonify({
+            "success": True,
+            "status": "incorrect",
+            "message": "The code is incorrect. Try again."
+        })
+
+if __name__ == '__main__':
+    print("Starting Flask server. Access at http://127.0.0.1:5000/")
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,20 @@
+# wsgi.py
+# Production entry point. The dev server in app.py is single-threaded, so
+# every concurrent /generate_story serializes behind the previous request's
+# Gemini call. Run this instead with:
+#
+#   SECRET_KEY=... REDIS_URL=... gunicorn -k gevent -w $(nproc) --worker-connections 200 wsgi:app
+#
+# With more than one worker, REDIS_URL is needed so all workers see the same
+# sessions, and SECRET_KEY so they all accept each other's session cookies
+# (the app refuses to start with REDIS_URL but no SECRET_KEY).
+#
+# The monkey-patch must run before anything else imports socket/ssl, so that
+# the Gemini client's HTTP calls become non-blocking greenlet switches.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402
+
+if __name__ == '__main__':
+    app.run()